@@ -1,11 +1,15 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
 import os
 import re
 import shutil
+import uuid
 import webbrowser
 from pathlib import Path
-from typing import Dict, Optional, List
+from typing import Callable, Dict, Optional, List
 
-from flask import Blueprint, Flask, Response, jsonify, current_app, redirect, render_template, request, send_file, session
+from flask import Blueprint, Flask, Response, jsonify, current_app, redirect, render_template, request, session
 from flask_executor import Executor
 from pandas import DataFrame
 import pandas as pd
@@ -17,6 +21,16 @@ from geo_matcher import map
 
 bp = Blueprint("matching", __name__)
 executor = Executor()
+pending_maps: Dict[Path, Future] = {}
+cached_maps: OrderedDict[Path, None] = OrderedDict()
+cached_maps_lock = Lock()
+
+USERNAME_PATTERN = re.compile(r"^[a-zA-Z0-9_-]+$")
+LABEL_MODES = frozenset({"all", "unlabeled", "cross-validate"})
+PREGENERATED_PAIR_MAPS = 3
+MAX_CACHED_MAPS = 1000
+DOWNLOAD_CHUNK_SIZE = 10_000
+MAP_MAX_AGE = 365 * 24 * 60 * 60
 
 class MissingDataset(Exception):
     """Raised when no dataset is selected in the session."""
@@ -29,10 +43,14 @@ def create_app(data_path: str, annotation_redundancy: int, consensus_margin: int
     app = Flask(__name__)
     app.secret_key = os.getenv("SECRET_KEY") or "dev-mode"
     app.maps_dir = Path(app.static_folder) / "maps"
+    # Maps are regenerated after a restart, so their URLs are versioned per app instance to allow long-term browser caching
+    app.maps_version = uuid.uuid4().hex[:8]
     app.url_map.strict_slashes = False
     _ensure_empty_dir(app.maps_dir)
 
     app.register_blueprint(bp)
+    # Leave one core for serving requests while maps are pre-generated
+    app.config["EXECUTOR_MAX_WORKERS"] = max(1, (os.cpu_count() or 1) - 1)
     executor.init_app(app)
 
     app.state_handler = StateHandler(data_path, annotation_redundancy, consensus_margin)
@@ -58,6 +76,25 @@ def ensure_session_defaults() -> None:
     session.setdefault("username", "unknown")
 
 
+@bp.app_context_processor
+def inject_maps_version() -> Dict[str, str]:
+    return {"maps_version": current_app.maps_version}
+
+
+@bp.after_app_request
+def cache_maps(response: Response) -> Response:
+    """
+    Let browsers cache generated maps, which do not change once created.
+    """
+    if request.path.startswith("/static/maps/") and response.status_code == 200:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = MAP_MAX_AGE
+        response.cache_control.immutable = True
+
+    return response
+
+
 @bp.app_errorhandler(MissingDataset)
 def handle_missing_dataset(error):
     current_app.logger.info("No dataset selected. Redirecting to landing page.")
@@ -92,10 +129,10 @@ def start_session():
     label_mode = request.form.get("labelmode")
     dataset = request.form.get("dataset")
 
-    if not username or not re.match(r"^[a-zA-Z0-9_-]+$", username):
+    if not username or not USERNAME_PATTERN.match(username):
         return "Invalid username", 400
 
-    if label_mode not in ["all", "unlabeled", "cross-validate"]:
+    if label_mode not in LABEL_MODES:
         return "Invalid labeling mode", 400
 
     if dataset not in current_app.state_handler.datasets:
@@ -128,16 +165,14 @@ def show_candidate_pair(id_existing: str = None, id_new: str = None) -> Response
     if not S.valid_pair(id_existing, id_new):
         return f"Candidate pair ({id_existing}, {id_new}) not found", 404
 
-    name = _unq_name(id_existing, id_new)
-    fp = current_app.maps_dir / f"candidate_{name}.html"
-    map.create_candidate_pair_html(S, id_existing, id_new, fp)
+    fp = _map_path("candidate", _unq_name(id_existing, id_new))
+    _create_map(map.create_candidate_pair_html, S, id_existing, id_new, filepath=fp)
 
-    subsequent_pair = S.get_pair_after_next(mode, username)
-    if subsequent_pair[0]:
+    # Pre-generate several upcoming maps, so that quickly labeled pairs do not wait for their map
+    for subsequent_pair in S.get_upcoming_pairs(mode, username, n=PREGENERATED_PAIR_MAPS):
         current_app.logger.debug(f"Pre-generating HTML map for candidate pair {subsequent_pair}")
-        next_name = _unq_name(*subsequent_pair)
-        next_fp = current_app.maps_dir / f"candidate_{next_name}.html"
-        executor.submit(map.create_candidate_pair_html, S, *subsequent_pair, next_fp)
+        next_fp = _map_path("candidate", _unq_name(*subsequent_pair))
+        _pregenerate_map(map.create_candidate_pair_html, S, *subsequent_pair, filepath=next_fp)
 
     return render_template(
         "show_candidate_pair.html",
@@ -168,13 +203,13 @@ def show_neighborhood(id: Optional[str] = None) -> Response:
     if id not in S.get_all_neighborhoods():
         return "Neighborhood not found", 404
 
-    fp = current_app.maps_dir / f"neighborhood_{id}.html"
-    map.create_neighborhood_html(S, id, fp)
+    fp = _map_path("neighborhood", id)
+    _create_map(map.create_neighborhood_html, S, id, filepath=fp)
 
     if subsequent_id := S.get_neighborhood_after_next(mode, username):
         current_app.logger.debug(f"Pre-generating HTML map for neighborhood {subsequent_id}")
-        next_fp = current_app.maps_dir / f"neighborhood_{subsequent_id}.html"
-        executor.submit(map.create_neighborhood_html, S, subsequent_id, next_fp)
+        next_fp = _map_path("neighborhood", subsequent_id)
+        _pregenerate_map(map.create_neighborhood_html, S, subsequent_id, filepath=next_fp)
 
     return render_template(
         "show_neighborhood.html",
@@ -243,11 +278,18 @@ def download_results() -> Response:
     """
     Download the results of the labeling process as a CSV file.
     """
-    S = _get_state()
-    path = S.results_path.with_name("labeled-pairs.csv").absolute()
-    S.store_aggregated_results(path)
+    results = _get_state().aggregate_results()
 
-    return send_file(path, as_attachment=True)
+    def generate_csv():
+        yield results.iloc[:0].to_csv(index=False)
+        for start in range(0, len(results), DOWNLOAD_CHUNK_SIZE):
+            yield results.iloc[start:start + DOWNLOAD_CHUNK_SIZE].to_csv(index=False, header=False)
+
+    return Response(
+        generate_csv(),
+        mimetype="text/csv",
+        headers={"Content-Disposition": "attachment; filename=labeled-pairs.csv"},
+    )
 
 
 def _get_state() -> State:
@@ -267,32 +309,91 @@ def _update_removed_matches(candidate_pairs: DataFrame, removed: List[Dict]) ->
 
 
 def _update_matches(candidate_pairs: DataFrame, matches: List[Dict], label: str, add_if_missing: bool) -> DataFrame:
-    new_candidate_pairs = []
-    for match in matches:
-        id_existing = match.get("id_existing")
-        id_new = match.get("id_new")
-        if not id_existing or not id_new:
-            continue
-
-        mask = (candidate_pairs["id_existing"] == id_existing) & (candidate_pairs["id_new"] == id_new)
-        if mask.any():
-            candidate_pairs.loc[mask, "match"] = label
-        elif add_if_missing:
-            new_candidate_pairs.append({
-                "id_existing": id_existing,
-                "id_new": id_new,
-                "match": label
-            })
-
-    candidate_pairs = pd.concat([candidate_pairs, DataFrame(new_candidate_pairs)], ignore_index=True)
+    matches = DataFrame(matches, columns=["id_existing", "id_new"])
+    matches = matches[matches.fillna("").astype(bool).all(axis=1)]
+
+    # Match all pairs at once by their ID pair instead of scanning the candidate pairs for each match
+    pairs = pd.MultiIndex.from_frame(candidate_pairs[["id_existing", "id_new"]])
+    selected = pd.MultiIndex.from_frame(matches)
+
+    mask = pairs.isin(selected)
+    if mask.any():
+        candidate_pairs.loc[mask, "match"] = label
+
+    missing = matches[~selected.isin(pairs)]
+    if add_if_missing and not missing.empty:
+        candidate_pairs = pd.concat([candidate_pairs, missing.assign(match=label)], ignore_index=True)
 
     return candidate_pairs
 
 
+def _map_path(kind: str, name: str) -> Path:
+    # Existing maps are not regenerated, so they must not collide between datasets with the same IDs
+    return current_app.maps_dir / f"{session.get('dataset')}_{kind}_{name}.html"
+
+
+def _create_map(create_html: Callable[..., None], *args, filepath: Path) -> None:
+    with cached_maps_lock:
+        future = pending_maps.get(filepath)
+
+    # Render a queued pre-generation of the same map right away instead of waiting behind other queued maps,
+    # but wait for a running one instead of rendering the map twice
+    if future is not None and not future.cancel():
+        future.exception()
+
+    create_html(*args, filepath)
+    _track_cached_map(filepath)
+
+
+def _pregenerate_map(create_html: Callable[..., None], *args, filepath: Path) -> None:
+    with cached_maps_lock:
+        if filepath in pending_maps or filepath.is_file():
+            return
+
+        future = executor.submit(create_html, *args, filepath)
+        pending_maps[filepath] = future
+
+    future.add_done_callback(lambda _: _forget_pending_map(filepath, future))
+    _track_cached_map(filepath)
+
+
+def _forget_pending_map(filepath: Path, future: Future) -> None:
+    with cached_maps_lock:
+        if pending_maps.get(filepath) is future:
+            del pending_maps[filepath]
+
+
+def _track_cached_map(filepath: Path) -> None:
+    # Generated maps are reused on revisits, so bound the size of the maps directory by removing the least recently used ones
+    with cached_maps_lock:
+        cached_maps[filepath] = None
+        cached_maps.move_to_end(filepath)
+
+        excess = len(cached_maps) - MAX_CACHED_MAPS
+        if excess > 0:
+            # Skip maps that are still being generated, as their upcoming visit would otherwise find no or a partial file
+            evicted = [fp for fp in cached_maps if fp not in pending_maps][:excess]
+            for fp in evicted:
+                del cached_maps[fp]
+                fp.unlink(missing_ok=True)
+
+
 def _unq_name(id_existing: str, id_new: str) -> str:
     return f"{id_existing}--{id_new}"
 
 
 def _ensure_empty_dir(path: Path) -> None:
-    shutil.rmtree(path, ignore_errors=True)
+    # The maps directory is usually flat, so unlinking its files avoids the per-entry directory checks of shutil.rmtree
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    continue
+                try:
+                    os.unlink(entry.path)
+                except OSError:
+                    pass
+    except OSError:
+        pass
     path.mkdir(parents=True, exist_ok=True)
@@ -1,10 +1,9 @@
 import click
 
-from geo_matcher import app, dataset
-
 DATASET_FILE = "candidate-pairs.pickle"
 RESULTS_FILE = "."
 
+
 @click.group()
 def cli() -> None:
     pass
@@ -32,6 +31,9 @@ def label(path: str, annotation_redundancy: int, consensus_margin: int) -> None:
 
     PATH to the dataset of building pairs.
     """
+    # Import lazily, so that the CLI starts without loading the geo stack until a command needs it
+    from geo_matcher import app
+
     click.echo("Starting browser app...")
     app.start_locally(path, annotation_redundancy, consensus_margin)
 
@@ -118,6 +120,8 @@ def create_labeling_dataset(
     FILEPATH1 to GeoParquet file containing the reference (existing) buildings.
     FILEPATH2 to GeoParquet file containing the new (to be added) buildings.
     """
+    from geo_matcher import dataset
+
     click.echo("Loading geodata...")
     dataset.log = click.echo
     dataset.create_candidate_pairs_dataset(
@@ -1,8 +1,10 @@
-from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Tuple
 import logging
+import os
 import warnings
 
-from geopandas import GeoDataFrame
+from geopandas import GeoDataFrame, GeoSeries
 from pandas import DataFrame
 import geopandas as gpd
 import numpy as np
@@ -17,6 +19,7 @@ warnings.simplefilter(action="ignore", category=FutureWarning)
 logger = logging.getLogger(__name__)
 log = logger.info
 
+
 def create_candidate_pairs_dataset(
     gdf1: GeoDataFrame = None,
     gdf2: GeoDataFrame = None,
@@ -58,18 +61,24 @@ def create_candidate_pairs_dataset(
     if max_distance is None:
         _verify_exhaustive_pairs(gdf1, gdf2, pairs)
 
-    if overlap_range:
-        pairs = _filter_candidate_pairs_by_overlap(pairs, gdf1, gdf2, overlap_range)
-
-    if similarity_range:
-        pairs = _filter_candidate_pairs_by_shape_similarity(pairs, gdf1, gdf2, similarity_range)
+    # Shape characteristics of buildings are reused across filtered batches of candidate pairs
+    shape_cache = {}
 
-    if max_overlap_others:
-        pairs = _filter_candidate_pairs_by_overlap_of_others(pairs, gdf1, gdf2, max_overlap_others)
+    def filter_fn(p: DataFrame) -> DataFrame:
+        return _filter_candidate_pairs(p, gdf1, gdf2, overlap_range, similarity_range, max_overlap_others, shape_cache)
 
     if n:
+        if overlap_range or similarity_range or max_overlap_others:
+            # Filters are expensive, so apply them only to a random subset large enough to yield n pairs
+            pairs = _filter_sampled_candidate_pairs(pairs, n, filter_fn)
         pairs = _sample_candidate_pairs(pairs, n)
         gdf1, gdf2 = _drop_buildings_elsewhere(gdf1, gdf2, pairs)
+    else:
+        pairs = filter_fn(pairs)
+
+    # Integer H3 cells are faster to group and filter, but neighborhood IDs are shown in URLs and stored with the labels
+    gdf1["neighborhood"] = spatial.h3_to_str(gdf1["neighborhood"])
+    gdf2["neighborhood"] = spatial.h3_to_str(gdf2["neighborhood"])
 
     return CandidatePairs(
         dataset_a=gdf1,
@@ -85,7 +94,7 @@ def _ensure_unique_index(
         gdf1 = gdf1.set_index(id_col)
         gdf2 = gdf2.set_index(id_col)
 
-    if not gdf1.index.is_unique or not gdf2.index.is_unique:
+    if gdf1.index.has_duplicates or gdf2.index.has_duplicates:
         gdf1 = gdf1.reset_index()
         gdf2 = gdf2.reset_index()
         log("Unique index is required. Creating new, numerical index.")
@@ -126,9 +135,9 @@ def _drop_buildings_elsewhere(
     """
     To reduce dataset size, remove buildings away from the candidate pairs.
     """
-    nbh1 = pairs["id_existing"].map(gdf1["neighborhood"])
-    nbh2 = pairs["id_new"].map(gdf2["neighborhood"])
-    nbh = pd.concat([nbh1, nbh2]).unique()
+    nbh1 = gdf1["neighborhood"].reindex(pairs["id_existing"]).to_numpy()
+    nbh2 = gdf2["neighborhood"].reindex(pairs["id_new"]).to_numpy()
+    nbh = np.unique(np.concatenate([nbh1, nbh2]))
     nbh_w_neighbors = spatial.h3_disk(nbh, k=1)
 
     gdf1 = gdf1[gdf1["neighborhood"].isin(nbh_w_neighbors)]
@@ -156,17 +165,42 @@ def _identify_candidate_pairs(
         idx1_nearest_a, idx2_nearest_a = spatial.nearest_neighbor(gdf1_non_intersect, gdf2, max_distance)
         idx2_nearest_b, idx1_nearest_b = spatial.nearest_neighbor(gdf2_non_intersect, gdf1, max_distance)
 
-        idx1 = np.concatenate([idx1, idx1_nearest_a, idx1_nearest_b])
-        idx2 = np.concatenate([idx2, idx2_nearest_a, idx2_nearest_b])
+        idx1 = _concat_ids(idx1, idx1_nearest_a, idx1_nearest_b)
+        idx2 = _concat_ids(idx2, idx2_nearest_a, idx2_nearest_b)
 
-    pairs = DataFrame({"id_existing": idx1, "id_new": idx2})
+    pairs = DataFrame({"id_existing": idx1, "id_new": idx2}, copy=False)
 
     # Drop duplicate pairs which were introduced because the two buildings are both nearest to each other
-    pairs = pairs.drop_duplicates()
+    pairs = _drop_duplicate_pairs(pairs)
 
     return pairs
 
 
+def _concat_ids(*ids: pd.Index) -> np.ndarray:
+    """
+    Concatenate building ids into a single preallocated buffer.
+    """
+    arrays = [np.asarray(i) for i in ids]
+    out = np.empty(sum(len(a) for a in arrays), dtype=np.result_type(*arrays))
+
+    start = 0
+    for a in arrays:
+        out[start:start + len(a)] = a
+        start += len(a)
+
+    return out
+
+
+def _drop_duplicate_pairs(pairs: DataFrame) -> DataFrame:
+    """
+    Drop duplicate pairs by hashing each row to a single uint64 key instead of comparing (object) ids column-wise.
+    """
+    keys = pd.util.hash_pandas_object(pairs, index=False).to_numpy()
+    _, first_idx = np.unique(keys, return_index=True)
+
+    return pairs.iloc[np.sort(first_idx)].reset_index(drop=True)
+
+
 def _identify_candidate_pairs_in_neighborhoods(
     gdf1: GeoDataFrame, gdf2: GeoDataFrame, neighborhoods: np.ndarray, max_distance: float
 ) -> DataFrame:
@@ -193,10 +227,9 @@ def _determine_overlapping_candidate_pairs(
     Identify candidate pairs of overlapping buildings footprints,
     retaining only the most overlapping pair for each building.
     """
-    idx1, idx2 = spatial.overlapping(gdf1, gdf2)
+    idx1, idx2, overlap = spatial.overlapping_with_relative_overlap(gdf1, gdf2, min_overlap=tolerance)
 
     # Filter slightly overlapping buildings
-    overlap = spatial.symmetrical_pairwise_relative_overlap(gdf1.loc[idx1], gdf2.loc[idx2])
     mask = overlap > tolerance
 
     pairs = pd.DataFrame({
@@ -206,74 +239,166 @@ def _determine_overlapping_candidate_pairs(
     })
 
     # For n:m relationships, keep only pair with the largest overlap
-    max_idx1 = pairs.sort_values("overlap", ascending=False).drop_duplicates(subset=["idx1"])
+    pairs = pairs.sort_values("overlap", ascending=False)
+    max_idx1 = pairs.drop_duplicates(subset=["idx1"])
     # Ensure symmetry, meaning that for each building in both gdf1 and gdf2 the pair with the respective largest overlap is kept
-    max_idx2 = pairs.sort_values("overlap", ascending=False).drop_duplicates(subset=["idx2"])
+    max_idx2 = pairs.drop_duplicates(subset=["idx2"])
     max_pairs = pd.concat([max_idx1, max_idx2])[["idx1", "idx2"]].drop_duplicates()
 
     return pd.Index(max_pairs["idx1"]), pd.Index(max_pairs["idx2"])
 
 
-def _filter_candidate_pairs_by_overlap(
-        pairs: DataFrame, gdf1: GeoDataFrame, gdf2: GeoDataFrame, overlap_range: Tuple[float, float]
+def _filter_candidate_pairs(
+    pairs: DataFrame,
+    gdf1: GeoDataFrame,
+    gdf2: GeoDataFrame,
+    overlap_range: Tuple[float, float],
+    similarity_range: Tuple[float, float],
+    max_overlap_others: float,
+    shape_cache: Dict[str, DataFrame] = None,
 ) -> DataFrame:
     """
-    Filter candidate pairs based on their degree of overlap, i.e. their Two-Way Area Overlap (TWAO).
+    Filter candidate pairs by overlap, shape similarity and overlap of other buildings.
     """
-    gdf1_can = gdf1.loc[pairs["id_existing"]]
-    gdf2_can = gdf2.loc[pairs["id_new"]]
+    if not (overlap_range or similarity_range or max_overlap_others):
+        return pairs
+
+    # Select the pair geometries once and narrow them down together with the pairs after each filter
+    geoms1 = gdf1.geometry.loc[pairs["id_existing"]]
+    geoms2 = gdf2.geometry.loc[pairs["id_new"]]
 
-    overlap = spatial.symmetrical_pairwise_relative_overlap(gdf1_can, gdf2_can)
-    mask = (overlap >= overlap_range[0]) & (overlap <= overlap_range[1])
+    if overlap_range:
+        mask = _overlap_mask(geoms1, geoms2, overlap_range)
+        pairs, geoms1, geoms2 = pairs[mask], geoms1[mask], geoms2[mask]
+
+    if similarity_range and not pairs.empty:
+        mask = _shape_similarity_mask(pairs, gdf1, gdf2, similarity_range, shape_cache)
+        pairs, geoms1, geoms2 = pairs[mask], geoms1[mask], geoms2[mask]
+
+    if max_overlap_others:
+        mask = _overlap_of_others_mask(pairs, geoms1, geoms2, gdf1, gdf2, max_overlap_others)
+        pairs = pairs[mask]
 
-    return pairs[mask]
+    return pairs
 
 
-def _filter_candidate_pairs_by_shape_similarity(
-        candidate_pairs: DataFrame, gdf1: GeoDataFrame, gdf2: GeoDataFrame, similarity_range: Tuple[float, float]
+def _filter_sampled_candidate_pairs(
+    pairs: DataFrame,
+    n: int,
+    filter_fn: Callable[[DataFrame], DataFrame],
+    oversample_factor: float = 1.5,
+    probe_size: int = 10_000,
 ) -> DataFrame:
     """
-    Filter candidate pairs based on their shape similarity.
+    Apply a row-wise filter to a random subset of candidate pairs just large enough to retain at least n pairs.
+
+    The filter retention rate is estimated from a random probe, which determines
+    how many further pairs are drawn until either n pairs remain or all pairs have been filtered.
+    """
+    order = np.random.default_rng(42).permutation(len(pairs))
+
+    k = min(len(pairs), max(n, probe_size))
+    filtered = [filter_fn(pairs.iloc[order[:k]])]
+    n_filtered = len(filtered[0])
+
+    while n_filtered < n and k < len(pairs):
+        retention = max(n_filtered, 1) / k
+        k_next = min(len(pairs), k + int(np.ceil((n - n_filtered) * oversample_factor / retention)))
+        filtered.append(filter_fn(pairs.iloc[order[k:k_next]]))
+        n_filtered += len(filtered[-1])
+        k = k_next
+
+    log(f"Filtered {k} of {len(pairs)} candidate pairs to sample {n} pairs.")
+
+    return pd.concat(filtered)
+
+
+def _overlap_mask(
+        geoms1: GeoSeries, geoms2: GeoSeries, overlap_range: Tuple[float, float]
+) -> np.ndarray:
+    """
+    Select candidate pairs based on their degree of overlap, i.e. their Two-Way Area Overlap (TWAO).
+    """
+    overlap = spatial.symmetrical_pairwise_relative_overlap(geoms1, geoms2, min_overlap=overlap_range[0])
+
+    return (overlap >= overlap_range[0]) & (overlap <= overlap_range[1])
+
+
+def _shape_similarity_mask(
+        candidate_pairs: DataFrame,
+        gdf1: GeoDataFrame,
+        gdf2: GeoDataFrame,
+        similarity_range: Tuple[float, float],
+        shape_cache: Dict[str, DataFrame] = None,
+) -> np.ndarray:
+    """
+    Select candidate pairs based on their shape similarity.
     """
-    gdf1_can = gdf1.loc[candidate_pairs["id_existing"]]
-    gdf2_can = gdf2.loc[candidate_pairs["id_new"]]
+    if shape_cache is None:
+        shape_cache = {}
 
-    similarity = spatial.shape_similarity(gdf1_can, gdf2_can)
-    mask = ((similarity >= similarity_range[0]) & (similarity <= similarity_range[1])).values
+    fts1 = _cached_shape_characteristics(gdf1, candidate_pairs["id_existing"], shape_cache, "existing")
+    fts2 = _cached_shape_characteristics(gdf2, candidate_pairs["id_new"], shape_cache, "new")
 
-    return candidate_pairs[mask]
+    similarity = spatial.characteristics_similarity(fts1, fts2)
 
+    return ((similarity >= similarity_range[0]) & (similarity <= similarity_range[1])).values
 
-def _filter_candidate_pairs_by_overlap_of_others(
-    pairs: DataFrame, gdf1: GeoDataFrame, gdf2: GeoDataFrame, max_overlap_others: float
+
+def _cached_shape_characteristics(
+    gdf: GeoDataFrame, ids: pd.Series, cache: Dict[str, DataFrame], key: str
 ) -> DataFrame:
     """
-    Keep only candidate pairs that are likely one-to-one match.
+    Calculate shape characteristics of buildings, reusing those already calculated for previous candidate pairs.
+    """
+    fts = cache.get(key)
+    missing = ids.unique() if fts is None else ids[~ids.isin(fts.index)].unique()
+
+    if len(missing) > 0:
+        new_fts = spatial.shape_characteristics(gdf.loc[missing])
+        fts = new_fts if fts is None else pd.concat([fts, new_fts])
+        cache[key] = fts
+
+    return fts.loc[ids]
+
+
+def _overlap_of_others_mask(
+    pairs: DataFrame,
+    geoms1: GeoSeries,
+    geoms2: GeoSeries,
+    gdf1: GeoDataFrame,
+    gdf2: GeoDataFrame,
+    max_overlap_others: float,
+) -> np.ndarray:
+    """
+    Select only candidate pairs that are likely one-to-one match.
     """
     gdf1_can = gdf1[gdf1.index.isin(pairs["id_existing"])]
     gdf2_can = gdf2[gdf2.index.isin(pairs["id_new"])]
 
-    # Calculate relative overlap between candidates and all other buildings
-    gdf1_can["overlap"] = spatial.relative_overlap(gdf1_can, gdf2)
-    gdf2_can["overlap"] = spatial.relative_overlap(gdf2_can, gdf1)
+    # The overlap computations are independent and mostly spent in GEOS, which releases the GIL.
+    # The CPUs are split between them, as each may intersect its pairs in parallel threads itself.
+    n_cpus = os.cpu_count() or 1
+    n_workers = min(3, n_cpus)
+    max_inner_workers = max(1, n_cpus // n_workers)
 
-    pairs["overlap_existing"] = pairs["id_existing"].map(gdf1_can["overlap"].fillna(0))
-    pairs["overlap_new"] = pairs["id_new"].map(gdf2_can["overlap"].fillna(0))
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        # Calculate relative overlap between candidates and all other buildings
+        overlap_existing = executor.submit(spatial.relative_overlap, gdf1_can, gdf2, max_inner_workers)
+        overlap_new = executor.submit(spatial.relative_overlap, gdf2_can, gdf1, max_inner_workers)
+        # Calculate relative overlap between candidate pair buildings
+        overlap_pair = executor.submit(spatial.mutual_pairwise_relative_overlap, geoms1, geoms2, max_inner_workers)
 
-    # Calculate relative overlap between candidate pair buildings
-    pair_geom_existing = gdf1.loc[pairs["id_existing"]]
-    pair_geom_new = gdf2.loc[pairs["id_new"]]
-    pairs["overlap_pair_existing"] = spatial.pairwise_relative_overlap(pair_geom_existing, pair_geom_new)
-    pairs["overlap_pair_new"] = spatial.pairwise_relative_overlap(pair_geom_new, pair_geom_existing)
+    overlap_existing = pairs["id_existing"].map(overlap_existing.result().fillna(0)).to_numpy()
+    overlap_new = pairs["id_new"].map(overlap_new.result().fillna(0)).to_numpy()
+    overlap_pair_existing, overlap_pair_new = overlap_pair.result()
 
     # Calculate relative overlap with other buildings only (apart from the candidate pair)
-    pairs["overlap_others_existing"] = pairs["overlap_existing"] - pairs["overlap_pair_existing"]
-    pairs["overlap_others_new"] = pairs["overlap_new"] - pairs["overlap_pair_new"]
+    overlap_others_existing = overlap_existing - overlap_pair_existing
+    overlap_others_new = overlap_new - overlap_pair_new
 
     # Identify candidate pairs with low overlap with other buildings suggesting a one-to-one match
-    mask = (pairs["overlap_others_existing"] < max_overlap_others) & (pairs["overlap_others_new"] < max_overlap_others)
-
-    return pairs[mask][["id_existing", "id_new"]]
+    return (overlap_others_existing < max_overlap_others) & (overlap_others_new < max_overlap_others)
 
 
 def _sample_candidate_pairs(
@@ -283,7 +408,8 @@ def _sample_candidate_pairs(
         log(f"Sampling size n ({n}) is larger than the number of candidate pairs ({len(pairs)}). Reducing n to {len(pairs)}.")
         n = len(pairs)
 
-    sample = pairs.sample(n=n, random_state=42).reset_index(drop=True)
+    idx = np.random.default_rng(42).choice(len(pairs), size=n, replace=False)
+    sample = pairs.iloc[idx].reset_index(drop=True)
 
     return sample
 
@@ -299,7 +425,7 @@ def _sample_neighborhoods(
         log(f"Sampling size n ({n}) is larger than the number of neighborhoods ({len(probs)}). Reducing n to {len(probs)}.")
         n = len(probs)
 
-    nbh = probs.sample(n=n, weights=probs, random_state=42).index.values
+    nbh = np.random.default_rng(42).choice(probs.index.to_numpy(), size=n, replace=False, p=probs.to_numpy())
 
     return nbh
 
@@ -329,4 +455,4 @@ def _filter_candidate_pairs_by_neighborhood(
 
 
 def _indices_overlap(gdf1: GeoDataFrame, gdf2: GeoDataFrame) -> bool:
-    return not gdf1.index.intersection(gdf2.index).empty
+    return bool(gdf1.index.isin(gdf2.index).any())
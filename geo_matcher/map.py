@@ -1,10 +1,15 @@
+from functools import lru_cache
 import json
+import os
+import uuid
 from pathlib import Path
-from typing import Any, Callable, Optional
+from typing import Any, Callable, Optional, Tuple
 
 from geopandas import GeoDataFrame
 import folium
 import geopandas as gpd
+import pandas as pd
+import xyzservices
 
 from geo_matcher.state import State
 from geo_matcher import spatial
@@ -33,17 +38,21 @@ BUILDING_LAYER_COLORS = {
     },
 }
 
+ESRI_SATELLITE = xyzservices.TileProvider(
+    name="Esri Satellite",
+    url="https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}",
+    attribution="Esri",
+)
+
 def create_tutorial_html(filepath: str) -> None:
     """
     Create a demo Folium HTML map with an example candidate pair and an instruction text.
     """
-    # Load demo data
-    demo_data_path = Path(__file__).parent / "data" / "tutorial-candidate.parquet"
-    gdf = gpd.read_parquet(demo_data_path)
+    gdf = _load_tutorial_candidate()
     existing_buildings = gdf.loc[["A", "A_candidate"]]
     new_buildings = gdf.loc[["B", "B_candidate"]]
 
-    c = new_buildings.centroid.loc["B_candidate"]
+    c = new_buildings.geometry.loc["B_candidate"].centroid
     lat, lon = spatial.to_lat_lon(c.x, c.y, existing_buildings.crs)
 
     # Initialize map and add demo buildings
@@ -53,20 +62,14 @@ def create_tutorial_html(filepath: str) -> None:
     _add_tutorial_marker(m, lat, lon)
     _add_baselayer_marker(m)
 
-    m.save(filepath)
+    _save_map(m, filepath)
+
 
 def create_neighborhood_tutorial_html(filepath: str) -> None:
     """
     Create a demo Folium HTML map with an example neighborhood and an instruction text.
     """
-    # Load demo data
-    demo_data_path = Path(__file__).parent / "data" / "tutorial-neighborhood.pickle"
-    data = CandidatePairs.load(demo_data_path)
-    data.preliminary_matching_estimate()
-
-    pairs = GeoDataFrame(data.pairs)
-    pairs["geometry_existing"] = pairs["id_existing"].map(data.dataset_a.geometry)
-    pairs["geometry_new"] = pairs["id_new"].map(data.dataset_b.geometry)
+    data, pairs = _load_tutorial_neighborhood()
 
     # Initialize map and add demo buildings
     m = _initialize_map(44.8031, 3.42505, 20)
@@ -79,7 +82,7 @@ def create_neighborhood_tutorial_html(filepath: str) -> None:
 
     folium.LayerControl(collapsed=True).add_to(m)
 
-    m.save(filepath)
+    _save_map(m, filepath)
 
 
 def create_candidate_pair_html(state: State, id_existing: str, id_new: str, filepath: Path) -> None:
@@ -91,7 +94,7 @@ def create_candidate_pair_html(state: State, id_existing: str, id_new: str, file
 
     candidate_pair = state.get_candidate_pair(id_existing, id_new)
 
-    c = candidate_pair["geometry_new"].centroid
+    c = candidate_pair["centroid_new"]
     existing_buildings = state.get_existing_buildings_at(c)
     new_buildings = state.get_new_building_at(c)
 
@@ -108,7 +111,7 @@ def create_candidate_pair_html(state: State, id_existing: str, id_new: str, file
 
     folium.LayerControl(collapsed=True).add_to(m)
 
-    m.save(filepath)
+    _save_map(m, filepath)
 
 
 def create_neighborhood_html(state: State, id: str, filepath: Path) -> None:
@@ -122,8 +125,10 @@ def create_neighborhood_html(state: State, id: str, filepath: Path) -> None:
     existing_buildings = state.get_existing_buildings(id)
     new_buildings = state.get_new_buildings(id)
 
-    new_buildings = new_buildings.loc[candidate_pairs["id_new"].unique()]
-    existing_buildings = existing_buildings.loc[candidate_pairs["id_existing"].unique()]
+    new_ids = pd.unique(candidate_pairs["id_new"].to_numpy())
+    existing_ids = pd.unique(candidate_pairs["id_existing"].to_numpy())
+    new_buildings = new_buildings.loc[new_ids]
+    existing_buildings = existing_buildings.loc[existing_ids]
 
     lat, lon = spatial.center_lat_lon(candidate_pairs["geometry_new"])
     m = _initialize_map(lat, lon, 19)
@@ -139,7 +144,46 @@ def create_neighborhood_html(state: State, id: str, filepath: Path) -> None:
 
     folium.LayerControl(collapsed=True).add_to(m)
 
-    m.save(filepath)
+    _save_map(m, filepath)
+
+
+@lru_cache(maxsize=1)
+def _load_tutorial_candidate() -> GeoDataFrame:
+    """
+    Load the static demo data of the candidate pair tutorial once.
+    """
+    demo_data_path = Path(__file__).parent / "data" / "tutorial-candidate.parquet"
+    return gpd.read_parquet(demo_data_path)
+
+
+@lru_cache(maxsize=1)
+def _load_tutorial_neighborhood() -> Tuple[CandidatePairs, GeoDataFrame]:
+    """
+    Load the static demo data of the neighborhood tutorial once, including its candidate pairs with their estimated matches and geometries.
+    """
+    demo_data_path = Path(__file__).parent / "data" / "tutorial-neighborhood.pickle"
+    data = CandidatePairs.load(demo_data_path)
+    data.preliminary_matching_estimate()
+
+    # Select only the pairs' geometries instead of mapping ids onto all buildings' geometries and centroids
+    pairs = GeoDataFrame(data.pairs)
+    pairs["geometry_existing"] = data.dataset_a.geometry.reindex(pairs["id_existing"]).values
+    pairs["geometry_new"] = data.dataset_b.geometry.reindex(pairs["id_new"]).values
+    pairs["centroid_existing"] = pairs["geometry_existing"].centroid
+    pairs["centroid_new"] = pairs["geometry_new"].centroid
+
+    return data, pairs
+
+
+def _save_map(m: folium.Map, filepath: Path) -> None:
+    # Write to a temporary file first, so that a partially written map is never served or mistaken for an existing one
+    filepath = Path(filepath)
+    tmp_path = filepath.with_name(f".{filepath.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        m.save(tmp_path)
+        os.replace(tmp_path, filepath)
+    finally:
+        tmp_path.unlink(missing_ok=True)
 
 
 def _initialize_map(lat: float, lon: float, zoom_level: int) -> folium.Map:
@@ -147,19 +191,19 @@ def _initialize_map(lat: float, lon: float, zoom_level: int) -> folium.Map:
 
     # Highest resolution
     carto = folium.TileLayer(
-        "CartoDB.Positron",
+        _tile_provider("CartoDB.Positron"),
         name="CartoDB Positron",
         show=True,
     )
     # Familiar map style
     osm = folium.TileLayer(
-        "OpenStreetMap",
+        _tile_provider("OpenStreetMap.Mapnik"),
         name="OpenStreetMap",
         show=False,
     )
     # Satellite imagery
     esri = folium.TileLayer(
-        tiles='https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
+        tiles=ESRI_SATELLITE,
         attr='Esri',
         name='Esri Satellite',
         max_native_zoom=18,
@@ -168,7 +212,7 @@ def _initialize_map(lat: float, lon: float, zoom_level: int) -> folium.Map:
     )
     # Base map without buildings
     esri_topo = folium.TileLayer(
-        "Esri.WorldTopoMap",
+        _tile_provider("Esri.WorldTopoMap"),
         name="Esri WorldTopoMap",
         show=False,
         max_native_zoom=18,
@@ -188,6 +232,14 @@ def _initialize_map(lat: float, lon: float, zoom_level: int) -> folium.Map:
     return m
 
 
+@lru_cache(maxsize=None)
+def _tile_provider(name: str) -> xyzservices.TileProvider:
+    """
+    Look up a tile provider once, since folium otherwise searches all xyzservices providers for each tile layer by name.
+    """
+    return xyzservices.providers.query_name(name)
+
+
 def _add_tutorial_marker(m: folium.Map, lat: float, lon: float) -> None:
     folium.Marker(
         location=[lat, lon],
@@ -216,10 +268,8 @@ def _add_stylized_buildings_layer(
         color_scheme = BUILDING_LAYER_COLORS["map"][layer_ref]
         return color_scheme["highlight"] if is_highlight else color_scheme["default"]
 
-    gdf["type"] = layer_ref
-
     feature_group = folium.FeatureGroup(name=layer_name)
-    geojson = _create_buildings_layer(gdf, style_function)
+    geojson = _create_buildings_layer(gdf, layer_ref, style_function)
     geojson.add_to(feature_group)
     feature_group.add_to(m)
 
@@ -231,6 +281,7 @@ def _add_stylized_buildings_layer(
 
 def _create_buildings_layer(
     gdf: GeoDataFrame,
+    layer_ref: str,
     style_function: Callable[[dict], dict],
 ) -> folium.GeoJson:
     def highlight_function(_):
@@ -239,9 +290,15 @@ def _create_buildings_layer(
     if gdf.empty:
         return folium.GeoJson({"type": "FeatureCollection", "features": []})
 
+    # Serialize geometries in bulk instead of via the GeoDataFrame's __geo_interface__,
+    # including only the properties used by the tooltip, styling and custom JS. The layer type is added to the
+    # properties rather than as a column, as the GeoDataFrame may be shared, e.g. the cached tutorial data
+    props = ({"index": i, "type": layer_ref} for i in gdf.index.tolist())
+    data = spatial.geometries_to_features(gdf.geometry, props)
+
     tooltip = folium.GeoJsonTooltip(fields=["index"], aliases=["Building ID"])
     features = folium.GeoJson(
-        gdf.reset_index(),
+        data,
         tooltip=tooltip,
         style_function=style_function,
         highlight_function=highlight_function,
@@ -253,15 +310,17 @@ def _create_buildings_layer(
 def _inject_matching_relationships(m: folium.Map, candidate_pairs: GeoDataFrame) -> None:
     matches = candidate_pairs[candidate_pairs["match"]]
     if matches.empty:
-        matching_edges = gpd.GeoDataFrame(geometry=[], crs=candidate_pairs["geometry_existing"].crs)
+        matching_edges = json.dumps({"type": "FeatureCollection", "features": []})
     else:
-        matching_edges = spatial.connect_with_lines(
+        matching_edges = spatial.to_geojson(spatial.connect_with_lines(
             matches.set_index("id_existing")["geometry_existing"],
-            matches.set_index("id_new")["geometry_new"]
-        ).reset_index(names=["id_existing", "id_new"])
+            matches.set_index("id_new")["geometry_new"],
+            centroids1=matches["centroid_existing"].values,
+            centroids2=matches["centroid_new"].values,
+        ).reset_index(names=["id_existing", "id_new"]))
 
     _inject_var(m, "pairs", candidate_pairs[["id_existing", "id_new", "match"]].to_json(orient='records'))
-    _inject_var(m, "initialMatches", matching_edges.to_json(to_wgs84=True))
+    _inject_var(m, "initialMatches", matching_edges)
 
 
 def _disable_leaflet_click_outline(m: folium.Map) -> None:
@@ -340,22 +399,54 @@ def _add_legend(m: folium.Map, candidates_highlighted=False) -> None:
     """)
 
 
-def _inject_element(m: folium.Map, element: str) -> None:
-    m.get_root().html.add_child(folium.Element(element))
+class _RawElement(folium.Element):
+    """
+    HTML element inserted verbatim, avoiding the compilation of its content as a Jinja template.
+    """
 
+    def __init__(self, html: str) -> None:
+        super().__init__()
+        self.html = html
 
-def _inject_var(m: folium.Map, name: str, data: Any) -> None:
-    _inject_element(m, f"""
+    def render(self, **kwargs) -> str:
+        return self.html
+
+
+class _InjectedVars(folium.Element):
+    """
+    Single script element assigning all injected global JavaScript variables once the DOM is loaded.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.vars = {}
+
+    def render(self, **kwargs) -> str:
+        assignments = "\n".join(f"window.{name} = {data};" for name, data in self.vars.items())
+        return f"""
     <script>
     document.addEventListener("DOMContentLoaded", function () {{
-        window.{name} = {data};
+        {assignments}
     }});
     </script>
-    """)
+    """
+
+
+def _inject_element(m: folium.Map, element: str) -> None:
+    m.get_root().html.add_child(_RawElement(element))
+
+
+def _inject_var(m: folium.Map, name: str, data: Any) -> None:
+    # Keep a reference to the map's script element, so that all variables are assigned by the same element
+    if not hasattr(m, "injected_vars"):
+        m.injected_vars = _InjectedVars()
+        m.get_root().html.add_child(m.injected_vars)
+
+    m.injected_vars.vars[name] = data
 
 
 def _inject_css(m: folium.Map, css: str) -> None:
-    m.get_root().header.add_child(folium.Element(f"""
+    m.get_root().header.add_child(_RawElement(f"""
     <style>
     {css}
     </style>
@@ -1,54 +1,68 @@
-from typing import Tuple, List
-
-from pyproj import Transformer
-from geopandas import GeoDataFrame
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import repeat
+import json
+import os
+from typing import Any, Dict, Iterable, Optional, Tuple, Union
+
+from pyproj import CRS, Transformer
+from geopandas import GeoDataFrame, GeoSeries
 from pandas import DataFrame, Series, Index, MultiIndex
-from shapely.geometry import LineString, Point, Polygon
+from shapely import STRtree
+from shapely.geometry import Point
+from h3.api import numpy_int as h3_int
 import h3
 import numpy as np
 import momepy
+import shapely
 
 
-def relative_overlap(gdf1: GeoDataFrame, gdf2: GeoDataFrame) -> Series:
+def relative_overlap(gdf1: GeoDataFrame, gdf2: GeoDataFrame, max_workers: Optional[int] = None) -> Series:
     """
     Calculate the share of each building's footprint overlapped by buildings in another GeoDataFrame.
+    The intersections are computed with at most max_workers threads (default: number of CPUs).
     """
-    geoms1 = gdf1.geometry
-    geoms2 = gdf2.geometry
+    geoms1 = gdf1.geometry.values
+    geoms2 = gdf2.geometry.values
 
     idx1, idx2 = gdf2.sindex.query(geoms1, predicate="intersects")
 
-    intersection = geoms1.iloc[idx1].intersection(geoms2.iloc[idx2], align=False)
-    intersection_area = intersection.area.groupby(level=0).sum()
-    area = geoms1.area.loc[intersection_area.index]
+    intersection_area = _intersection_area(geoms1[idx1], geoms2[idx2], max_workers=max_workers)
+    intersection_area = np.bincount(idx1, weights=intersection_area, minlength=len(geoms1))
 
-    return intersection_area / area
+    return Series(intersection_area / shapely.area(geoms1), index=gdf1.index)
 
 
 def pairwise_relative_overlap(gdf1: GeoDataFrame, gdf2: GeoDataFrame) -> np.ndarray:
     """
     Calculate the share of each building's footprint overlapped by its pair in another GeoDataFrame.
     """
-    geoms1 = gdf1.geometry.reset_index()
-    geoms2 = gdf2.geometry.reset_index()
+    return mutual_pairwise_relative_overlap(gdf1, gdf2)[0]
+
+
+def mutual_pairwise_relative_overlap(
+    gdf1: GeoDataFrame, gdf2: GeoDataFrame, max_workers: Optional[int] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Calculate the share of each building's footprint overlapped by its pair and vice versa, intersecting each pair only once.
+    The intersections are computed with at most max_workers threads (default: number of CPUs).
+    """
+    geoms1 = gdf1.geometry.values
+    geoms2 = gdf2.geometry.values
 
-    intersection_area = geoms1.intersection(geoms2).area
-    area = geoms1.area
+    intersection_area = _intersection_area(geoms1, geoms2, max_workers=max_workers)
 
-    return (intersection_area / area).values
+    return intersection_area / shapely.area(geoms1), intersection_area / shapely.area(geoms2)
 
 
-def symmetrical_pairwise_relative_overlap(gdf1: GeoDataFrame, gdf2: GeoDataFrame) -> np.ndarray:
+def symmetrical_pairwise_relative_overlap(
+    gdf1: GeoDataFrame, gdf2: GeoDataFrame, min_overlap: float = 0.0
+) -> np.ndarray:
     """
     Calculate Two-Way Area Overlap (TWAO) between building pairs.
+    Pairs whose bounding boxes cannot overlap by at least min_overlap are skipped and assigned an overlap of 0.
     """
-    geoms1 = gdf1.geometry.reset_index()
-    geoms2 = gdf2.geometry.reset_index()
-
-    intersection_area = geoms1.intersection(geoms2).area
-    area = np.minimum(geoms1.area, geoms2.area)
-
-    return (intersection_area / area).values
+    return _symmetrical_relative_overlap(gdf1.geometry.values, gdf2.geometry.values, min_overlap)
 
 
 def corresponding(gdf1: GeoDataFrame, gdf2: GeoDataFrame) -> np.array:
@@ -66,16 +80,36 @@ def overlapping(
     """
     Find all overlapping building pairs between two GeoDataFrames.
     """
-    idx2, idx1 = gdf1.sindex.query(gdf2.geometry, predicate="intersects")
+    idx2, idx1 = gdf1.sindex.query(gdf2.geometry.values, predicate="intersects")
 
     return gdf1.index[idx1], gdf2.index[idx2]
 
 
-def within(gdf: GeoDataFrame, loc: Point, dis: float) -> GeoDataFrame:
+def overlapping_with_relative_overlap(
+    gdf1: GeoDataFrame, gdf2: GeoDataFrame, min_overlap: float = 0.0
+) -> Tuple[Index, Index, np.ndarray]:
+    """
+    Find all overlapping building pairs between two GeoDataFrames together with their Two-Way Area Overlap (TWAO).
+    Combines overlapping and symmetrical_pairwise_relative_overlap without materializing the paired GeoDataFrames.
+    """
+    geoms1 = gdf1.geometry.values
+    geoms2 = gdf2.geometry.values
+
+    idx2, idx1 = gdf1.sindex.query(geoms2, predicate="intersects")
+    overlap = _symmetrical_relative_overlap(geoms1[idx1], geoms2[idx2], min_overlap)
+
+    return gdf1.index[idx1], gdf2.index[idx2], overlap
+
+
+def within(gdf: GeoDataFrame, loc: Point, dis: float, tree: Optional[STRtree] = None) -> GeoDataFrame:
     """
     Find all buildings within a certain distance from a given point.
+    A prebuilt spatial index of the GeoDataFrame's geometries can be passed to query it directly.
     """
-    idx = gdf.sindex.query(loc, predicate="dwithin", distance=dis)
+    if tree is None:
+        tree = gdf.sindex
+
+    idx = tree.query(loc, predicate="dwithin", distance=dis)
 
     return gdf.iloc[idx]
 
@@ -84,29 +118,46 @@ def nearest_neighbor(gdf1: GeoDataFrame, gdf2: GeoDataFrame, max_distance: float
     """
     For each building in gdf1, find the nearest building in gdf2 and return its index.
     """
-    idx1, idx2 = gdf2.sindex.nearest(gdf1.geometry, return_all=False, max_distance=max_distance)
+    idx1, idx2 = gdf2.sindex.nearest(gdf1.geometry.values, return_all=False, max_distance=max_distance)
 
     return gdf1.index[idx1], gdf2.index[idx2]
 
 
-def h3_index(gdf: GeoDataFrame, res: int) -> List[str]:
+def h3_index(gdf: GeoDataFrame, res: int) -> np.ndarray:
     """
-    Generate H3 indexes for the geometries in a GeoDataFrame.
+    Generate H3 indexes as 64-bit integers for the geometries in a GeoDataFrame.
     """
     # H3 operations require a lat/lon point geometry
     centroids = gdf.centroid.to_crs("EPSG:4326")
-    lngs = centroids.x
-    lats = centroids.y
-    h3_idx = [h3.latlng_to_cell(lat, lng, res) for lat, lng in zip(lats, lngs)]
+    lngs = centroids.x.to_numpy().tolist()
+    lats = centroids.y.to_numpy().tolist()
 
-    return h3_idx
+    return np.fromiter(
+        map(h3_int.latlng_to_cell, lats, lngs, repeat(res, len(lats))),
+        dtype=np.int64,
+        count=len(lats),
+    )
 
 
-def h3_disk(h3_indices: List[str], k: int) -> List[str]:
+def h3_disk(h3_indices: np.ndarray, k: int) -> np.ndarray:
     """
-    Determines all nearby cells for a list of h3 indices within k grid distance.
+    Determines all nearby cells for an array of integer h3 indices within k grid distance.
     """
-    return np.unique(np.ravel([h3.grid_disk(idx, k) for idx in h3_indices]))
+    disks = [h3_int.grid_disk(int(idx), k) for idx in np.unique(h3_indices)]
+    if not disks:
+        return np.array([], dtype=np.int64)
+
+    return np.unique(np.concatenate(disks)).astype(np.int64)
+
+
+def h3_to_str(h3_indices: np.ndarray) -> np.ndarray:
+    """
+    Convert integer h3 indices to their hexadecimal string representation.
+    """
+    # Many buildings share a cell, so only convert unique cells
+    unique_cells, inverse = np.unique(np.asarray(h3_indices), return_inverse=True)
+
+    return np.array([h3.int_to_str(int(c)) for c in unique_cells], dtype=object)[inverse]
 
 
 def center_lat_lon(gdf: GeoDataFrame) -> Point:
@@ -120,35 +171,90 @@ def center_lat_lon(gdf: GeoDataFrame) -> Point:
     return to_lat_lon(x, y, gdf.crs)
 
 
-def to_lat_lon(x: float, y: float, crs: str) -> Tuple[float, float]:
+def to_lat_lon(
+    x: Union[float, np.ndarray], y: Union[float, np.ndarray], crs: str
+) -> Tuple[Union[float, np.ndarray], Union[float, np.ndarray]]:
     """
     Convert coordinates to latitude and longitude.
+    Arrays of coordinates are converted in a single batched transformation.
     """
-    transformer = Transformer.from_crs(crs, "EPSG:4326", always_xy=True)
+    transformer = _lat_lon_transformer(CRS.from_user_input(crs).to_wkt())
     lon, lat = transformer.transform(x, y)
 
     return lat, lon
 
 
-def connect_with_lines(gdf1: GeoDataFrame, gdf2: GeoDataFrame) -> GeoDataFrame:
+@lru_cache(maxsize=32)
+def _lat_lon_transformer(crs: str) -> Transformer:
+    return Transformer.from_crs(crs, "EPSG:4326", always_xy=True)
+
+
+def to_geojson(gdf: GeoDataFrame) -> str:
+    """
+    Serialize a GeoDataFrame to a GeoJSON FeatureCollection string in WGS84 coordinates.
+    """
+    geoms = shapely.to_geojson(gdf.geometry.to_crs("EPSG:4326").values)
+    props = gdf.drop(columns=gdf.geometry.name).to_dict(orient="records")
+    features = ",".join(
+        f'{{"type": "Feature", "properties": {json.dumps(p, default=str)}, "geometry": {g}}}'
+        for p, g in zip(props, geoms)
+    )
+
+    return f'{{"type": "FeatureCollection", "features": [{features}]}}'
+
+
+def geometries_to_features(geoms: GeoSeries, properties: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Convert geometries and their respective properties to a GeoJSON FeatureCollection dict in WGS84 coordinates.
+    Properties are passed on as is, so they should consist of native Python types.
+    """
+    # Parse the geometries serialized in bulk at once instead of converting each geometry separately
+    geometries = json.loads(f'[{",".join(shapely.to_geojson(geoms.to_crs("EPSG:4326").values))}]')
+    features = [{"type": "Feature", "properties": p, "geometry": g} for p, g in zip(properties, geometries)]
+
+    return {"type": "FeatureCollection", "features": features}
+
+
+def connect_with_lines(
+    gdf1: GeoDataFrame,
+    gdf2: GeoDataFrame,
+    centroids1: Optional[np.ndarray] = None,
+    centroids2: Optional[np.ndarray] = None,
+) -> GeoDataFrame:
     """
     Row-wise connect centroids of two GeoDataFrames with lines.
+    Precomputed centroids can be passed to skip their calculation.
     """
-    edges = [
-        LineString([c1, c2])
-        for c1, c2 in zip(gdf1.centroid, gdf2.centroid)
-    ]
+    if centroids1 is None:
+        centroids1 = shapely.centroid(gdf1.geometry.values)
+    if centroids2 is None:
+        centroids2 = shapely.centroid(gdf2.geometry.values)
+
+    c1 = shapely.get_coordinates(centroids1)
+    c2 = shapely.get_coordinates(centroids2)
+    edges = shapely.linestrings(np.stack([c1, c2], axis=1))
 
-    return GeoDataFrame(geometry=edges, index=MultiIndex.from_tuples(zip(gdf1.index, gdf2.index)), crs=gdf1.crs)
+    return GeoDataFrame(geometry=edges, index=MultiIndex.from_arrays([gdf1.index, gdf2.index]), crs=gdf1.crs)
 
 
-def line_connects_two_polygons(line: LineString, poly1: Polygon, poly2: Polygon) -> bool:
+def line_connects_two_polygons(lines: np.ndarray, polys1: np.ndarray, polys2: np.ndarray) -> np.ndarray:
     """
-    Check if a line connects two polygons.
+    Row-wise check if lines connect two polygons.
     """
-    start = Point(line.coords[0])
-    end = Point(line.coords[-1])
-    return (poly1.contains(start) and poly2.contains(end)) or (poly1.contains(end) and poly2.contains(start))
+    # Prepared polygons speed up the repeated containment checks
+    shapely.prepare(polys1)
+    shapely.prepare(polys2)
+
+    # Check endpoint coordinates directly instead of constructing Point geometries
+    start = shapely.get_coordinates(shapely.get_point(lines, 0))
+    end = shapely.get_coordinates(shapely.get_point(lines, -1))
+    start_x, start_y = start[:, 0], start[:, 1]
+    end_x, end_y = end[:, 0], end[:, 1]
+
+    return (
+        (shapely.contains_xy(polys1, start_x, start_y) & shapely.contains_xy(polys2, end_x, end_y))
+        | (shapely.contains_xy(polys1, end_x, end_y) & shapely.contains_xy(polys2, start_x, start_y))
+    )
 
 
 def shape_similarity(gdf1: GeoDataFrame, gdf2: GeoDataFrame) -> Series:
@@ -159,9 +265,15 @@ def shape_similarity(gdf1: GeoDataFrame, gdf2: GeoDataFrame) -> Series:
     """
     fts1 = shape_characteristics(gdf1)
     fts2 = shape_characteristics(gdf2)
-    similarity = 1 - _average_percentage_diff(fts1, fts2)
 
-    return similarity
+    return characteristics_similarity(fts1, fts2)
+
+
+def characteristics_similarity(fts1: DataFrame, fts2: DataFrame) -> Series:
+    """
+    Calculate the shape similarity between building pairs from their precomputed shape characteristics.
+    """
+    return 1 - _average_percentage_diff(fts1, fts2)
 
 
 def shape_characteristics(gdf: GeoDataFrame) -> DataFrame:
@@ -173,19 +285,71 @@ def shape_characteristics(gdf: GeoDataFrame) -> DataFrame:
     - orientation
     """
     orig_index = gdf.index
-    gdf = gdf[~orig_index.duplicated()]
+    if orig_index.is_unique:
+        return _shape_characteristics(gdf)
 
+    fts = _shape_characteristics(gdf[~orig_index.duplicated()])
+
+    return fts.loc[orig_index]
+
+
+def _shape_characteristics(gdf: GeoDataFrame) -> DataFrame:
     fts = DataFrame(index=gdf.index)
     fts["bldg_footprint_area"] = gdf.area
     fts["bldg_longest_axis_length"] = momepy.longest_axis_length(gdf)
     fts["bldg_elongation"] = momepy.elongation(gdf)
     fts["bldg_orientation"] = momepy.orientation(gdf)
 
-    return fts.loc[orig_index]
+    return fts
+
+
+def _symmetrical_relative_overlap(geoms1: np.ndarray, geoms2: np.ndarray, min_overlap: float) -> np.ndarray:
+    area = np.minimum(shapely.area(geoms1), shapely.area(geoms2))
+
+    if min_overlap > 0:
+        # The bounding box intersection is a cheap upper bound of the exact intersection
+        upper_bound = np.minimum(_bbox_intersection_area(geoms1, geoms2), area) / area
+        candidates = upper_bound >= min_overlap
+        intersection_area = np.zeros(len(geoms1))
+        intersection_area[candidates] = _intersection_area(geoms1[candidates], geoms2[candidates])
+    else:
+        intersection_area = _intersection_area(geoms1, geoms2)
+
+    return intersection_area / area
+
+
+def _intersection_area(
+    geoms1: np.ndarray, geoms2: np.ndarray, min_chunk_size: int = 4096, max_workers: Optional[int] = None
+) -> np.ndarray:
+    # Shapely releases the GIL during GEOS operations, so large batches of pairs can be intersected in parallel threads
+    n_workers = min(max_workers or os.cpu_count() or 1, len(geoms1) // min_chunk_size)
+    if n_workers <= 1:
+        return shapely.area(shapely.intersection(geoms1, geoms2))
+
+    bounds = np.linspace(0, len(geoms1), n_workers + 1, dtype=int)
+    chunks = [slice(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        areas = executor.map(lambda chunk: shapely.area(shapely.intersection(geoms1[chunk], geoms2[chunk])), chunks)
+        return np.concatenate(list(areas))
+
+
+def _bbox_intersection_area(geoms1: np.ndarray, geoms2: np.ndarray) -> np.ndarray:
+    bounds1 = shapely.bounds(geoms1)
+    bounds2 = shapely.bounds(geoms2)
+
+    width = np.minimum(bounds1[:, 2], bounds2[:, 2]) - np.maximum(bounds1[:, 0], bounds2[:, 0])
+    height = np.minimum(bounds1[:, 3], bounds2[:, 3]) - np.maximum(bounds1[:, 1], bounds2[:, 1])
+
+    return np.maximum(width, 0) * np.maximum(height, 0)
 
 
 def _average_percentage_diff(gdf1: GeoDataFrame, gdf2: GeoDataFrame) -> Series:
-    p_diff = (gdf1.values - gdf2.values) / gdf2.values
+    values1 = gdf1.to_numpy(dtype=float)
+    values2 = gdf2.to_numpy(dtype=float)
+
+    # Undefined percentage differences (division by zero) become NaN
+    p_diff = np.divide(values1 - values2, values2, out=np.full_like(values1, np.nan), where=values2 != 0)
     avg_p_diff = np.abs(p_diff).mean(axis=1)
 
-    return Series(avg_p_diff, index=MultiIndex.from_tuples(zip(gdf1.index, gdf2.index)))
+    return Series(avg_p_diff, index=MultiIndex.from_arrays([gdf1.index, gdf2.index]))
@@ -1,18 +1,27 @@
 from collections import Counter
+import csv
 from datetime import datetime
+from itertools import islice
+import os
 from pathlib import Path
 from typing import Callable, Dict, List, Optional, Union
 
 from geopandas import GeoDataFrame
 from pandas import DataFrame, Series, Index
+from shapely import STRtree
 from shapely.geometry import Point
 from sklearn import metrics
+import numpy as np
 import pandas as pd
 
 from geo_matcher.candidate_pairs import CandidatePairs
 from geo_matcher import spatial
 
 
+RESULT_COLUMNS = ["neighborhood", "id_existing", "id_new", "match", "username", "time"]
+STORE_INTERVAL = 50
+
+
 class State:
     """
     Manage the state of the candidate building pair labeling process.
@@ -30,6 +39,8 @@ class State:
         self.annotation_redundancy = annotation_redundancy
         self.consensus_margin = consensus_margin
         self.results_path = Path(results_path)
+        # New labels are appended to a journal, which is compacted into the results file periodically
+        self.journal_path = self.results_path.with_suffix(".journal.csv")
         self.data = CandidatePairs.load(data_path)
         self.data.preliminary_matching_estimate()
         self.results = self._load_results()
@@ -39,60 +50,102 @@ class State:
         self.data_b = self.data.dataset_b
         self.pairs = self.data.pairs
 
+        # Centroids are required for every rendered map, so compute them once per building
+        self.centroids_a = self.data_a.centroid
+        self.centroids_b = self.data_b.centroid
+
+        # Plain dicts avoid the pandas indexing overhead when looking up a single candidate pair
+        self._geoms_a = dict(zip(self.data_a.index, self.data_a.geometry.values))
+        self._geoms_b = dict(zip(self.data_b.index, self.data_b.geometry.values))
+        self._centroids_b = dict(zip(self.centroids_b.index, self.centroids_b.values))
+
+        # Pairs that can be labeled, for hash-based URL validation. Besides the candidate pairs, these include
+        # pairs added as matches in neighborhood mode, which are queued for labeling like candidate pairs
+        self._pair_set = set(zip(self.pairs["id_existing"], self.pairs["id_new"]))
+
+        # Row positions of the buildings per neighborhood, to avoid scanning the neighborhood column per request
+        self._nbh_rows_a = self.data_a.groupby("neighborhood", sort=False).indices
+        self._nbh_rows_b = self.data_b.groupby("neighborhood", sort=False).indices
+
+        # Group candidate pairs by the neighborhood of the new building once instead of scanning all pairs per request
+        pair_neighborhoods = self.pairs["id_new"].map(self.data_b["neighborhood"])
+        self._neighborhoods = Index(pair_neighborhoods.unique())
+        self._pairs_by_neighborhood = dict(tuple(self.pairs.groupby(pair_neighborhoods, sort=False)))
+
+        # Spatial indices for the repeated map extent queries
+        self.tree_a = STRtree(self.data_a.geometry.values)
+        self.tree_b = STRtree(self.data_b.geometry.values)
+
+        self._all_pairs_cache = None
+        self._appended_since_store = 0
+
+        # Labeled pairs and neighborhoods, updated incrementally as results are added
+        self._labeled_pair_set = set()
+        self._labeled_nbh_set = set()
+        self._user_pair_sets = {}
+        self._user_nbh_sets = {}
+        self._latest_results = {}
+        self._match_counts = Counter()
+        self._track_results(self.results)
+
     def get_existing_buildings(self, neighborhood: str) -> GeoDataFrame:
         """
         Return existing buildings in or linked to the given neighborhood.
         """
-        nbh_a = self.data_a[self.data_a["neighborhood"] == neighborhood]
+        nbh_ids = self.data_a.index[self._neighborhood_rows(self._nbh_rows_a, neighborhood)]
 
         # Edge case: also get the existing buildings of candidate pairs, where only the new building is in the neighborhood of interest
-        nbh_b = self.data_b[self.data_b["neighborhood"] == neighborhood]
-        candidate_ids = self.pairs[self.pairs["id_new"].isin(nbh_b.index)]["id_existing"]
-        candidates = self.data_a.loc[candidate_ids]
+        candidate_ids = self._neighborhood_pairs(neighborhood)["id_existing"]
+
+        # Union by ID instead of comparing entire rows including geometries
+        ids = nbh_ids.append(pd.Index(candidate_ids)).unique()
 
-        return pd.concat([nbh_a, candidates]).drop_duplicates()
+        return self.data_a.loc[ids]
 
     def get_new_buildings(self, iteration: str) -> GeoDataFrame:
         """
         Return new buildings in the given neighborhood.
         """
-        return self.data_b[self.data_b["neighborhood"] == iteration]
+        return self.data_b.iloc[self._neighborhood_rows(self._nbh_rows_b, iteration)]
 
     def get_existing_buildings_at(self, loc: Point) -> GeoDataFrame:
         """
         Return existing buildings within 150 meters of the given location.
         """
-        return spatial.within(self.data_a, loc, dis=150)
+        return spatial.within(self.data_a, loc, dis=150, tree=self.tree_a)
 
     def get_new_building_at(self, loc: Point) -> GeoDataFrame:
         """
         Return new buildings within 150 meters of the given location.
         """
-        return spatial.within(self.data_b, loc, dis=150)
+        return spatial.within(self.data_b, loc, dis=150, tree=self.tree_b)
 
     def get_candidate_pair(self, id_existing: str, id_new: str) -> Series:
         """
-        Return a candidate pair including the geometry of both buildings.
+        Return a candidate pair including the geometry of both buildings and the centroid of the new building.
         """
         return Series({
             "id_existing": id_existing,
             "id_new": id_new,
-            "geometry_existing": self.data_a.geometry[id_existing],
-            "geometry_new": self.data_b.geometry[id_new],
+            "geometry_existing": self._geoms_a[id_existing],
+            "geometry_new": self._geoms_b[id_new],
+            "centroid_new": self._centroids_b[id_new],
         })
 
     def get_candidate_pairs(self, neighborhood: str) -> Union[DataFrame, GeoDataFrame]:
         """
-        Return all candidate pairs in the given neighborhood including their geometries.
+        Return all candidate pairs in the given neighborhood including their geometries and centroids.
         """
-        new = self.get_new_buildings(neighborhood)
-        pairs = self.pairs[self.pairs["id_new"].isin(new.index)]
+        pairs = self._neighborhood_pairs(neighborhood)
+        ids_existing = pairs["id_existing"].to_numpy()
+        ids_new = pairs["id_new"].to_numpy()
 
-        pairs = GeoDataFrame(pairs)
-        pairs["geometry_existing"] = pairs["id_existing"].map(self.data_a.geometry)
-        pairs["geometry_new"] = pairs["id_new"].map(self.data_b.geometry)
-
-        return pairs
+        return GeoDataFrame(pairs.assign(
+            geometry_existing=self.data_a.geometry.reindex(ids_existing).values,
+            geometry_new=self.data_b.geometry.reindex(ids_new).values,
+            centroid_existing=self.centroids_a.reindex(ids_existing).values,
+            centroid_new=self.centroids_b.reindex(ids_new).values,
+        ))
 
     def add_result(self, id_existing: str, id_new: str, match: str, username: str) -> None:
         """
@@ -101,37 +154,41 @@ class State:
         if match not in ["yes", "no", "unsure"]:
             raise ValueError(f"Match label '{match}' must be one of: 'yes', 'no', 'unsure'.")
 
-        self.results.append({
+        result = {
             "neighborhood": None,
             "id_existing": id_existing,
             "id_new": id_new,
             "match": match,
             "username": username,
             "time": datetime.now().isoformat(timespec="milliseconds")
-        })
-        self.store_results()
+        }
+        self.results.append(result)
+        self._track_results([result])
+        self._append_results([result])
 
         if len(self.results) % 10 == 0:
-            frequency = dict(Counter([e["match"] for e in self.results]))
+            frequency = dict(self._match_counts)
             self.logger(f"Progress: {len(self.results)} buildings labeled ({frequency})")
 
     def add_bulk_results(self, df: DataFrame) -> None:
         """
         Store multiple labeling decisions from a DataFrame.
         """
-        if not df["match"].isin(["yes", "no", "unsure"]).all():
+        if not set(df["match"].unique()).issubset({"yes", "no", "unsure"}):
             raise ValueError("Match label must be one of: 'yes', 'no', 'unsure'.")
 
         results = df[["neighborhood", "id_existing", "id_new", "match", "username"]]
         results["time"] = datetime.now().isoformat(timespec="milliseconds")
-        self.results.extend(results.to_dict(orient="records"))
-        self.store_results()
+        records = results.to_dict(orient="records")
+        self.results.extend(records)
+        self._track_results(records)
+        self._append_results(records)
 
     def valid_pair(self, id_existing: str, id_new: str) -> Series:
         """
-        Check whether a given ID pair exists in the candidate pairs.
+        Check whether a given ID pair exists in the candidate pairs or in the labeling results.
         """
-        return id_existing in self.pairs["id_existing"].values and id_new in self.pairs["id_new"].values
+        return (id_existing, id_new) in self._pair_set
 
     def get_next_pair(self, label_mode: str, user: str = None) -> Optional[tuple[str, str]]:
         """
@@ -148,7 +205,7 @@ class State:
             The next (id_existing, id_new) pair to be labeled, or (None, None) if no suitable pair is found.
         """
         try:
-            return self._next_pairs(label_mode, user)[0]
+            return self._next_pairs(label_mode, user, limit=1)[0]
 
         except IndexError:
             return None, None
@@ -168,16 +225,33 @@ class State:
             The next but one (id_existing, id_new) pair to be labeled, or (None, None) if no suitable pair is found.
         """
         try:
-            return self._next_pairs(label_mode, user)[1]
+            return self._next_pairs(label_mode, user, limit=2)[1]
 
         except IndexError:
             return None, None
 
+    def get_upcoming_pairs(self, label_mode: str, user: str = None, n: int = 3) -> List[tuple[str, str]]:
+        """
+        Return up to n candidate pairs to be labeled after the next one based on the selected labeling mode.
+
+        Args:
+            label_mode: Determines the labeling strategy. One of:
+                - 'all': Return only pairs that have not yet been labeled by the current user.
+                - 'unlabeled': Return only pairs that have not been at all or not enough times.
+                - 'cross-validate': Return pairs that have either been labeled only once or received conflicting labels, for cross-validation.
+            user: Optional. The current user's identifier.
+            n: Maximum number of pairs to return.
+
+        Returns:
+            A list of (id_existing, id_new) pairs following the next pair, which is empty if no suitable pair is found.
+        """
+        return self._next_pairs(label_mode, user, limit=n + 1)[1:]
+
     def get_all_neighborhoods(self) -> Index:
         """
         Return the unique list of neighborhoods in the dataset.
         """
-        return Index(self.pairs["id_new"].map(self.data_b["neighborhood"]).unique())
+        return self._neighborhoods
 
     def get_next_neighborhood(self, label_mode: str, user: str = None) -> Optional[str]:
         """
@@ -233,7 +307,15 @@ class State:
         """
         Save all labeled candidate pairs to disk as a CSV file.
         """
-        self._unique_results(include_unsure=True).to_csv(self.results_path, index=False)
+        # Replace the results file atomically, so it never lacks labels that were already removed from the journal
+        tmp_path = self.results_path.with_suffix(".csv.tmp")
+        with open(tmp_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=RESULT_COLUMNS, lineterminator="\n")
+            writer.writeheader()
+            writer.writerows(self._latest_results.values())
+        os.replace(tmp_path, self.results_path)
+        self.journal_path.unlink(missing_ok=True)
+        self._appended_since_store = 0
         self.logger(
             f"Labeled building pairs stored in {self.results_path}."
         )
@@ -242,14 +324,20 @@ class State:
         """
         Summarize sufficiently labeled pairs with majority vote and label count, then write to CSV.
         """
+        self.aggregate_results().to_csv(path, index=False)
+
+    def aggregate_results(self) -> DataFrame:
+        """
+        Summarize sufficiently labeled pairs with majority vote and label count.
+        """
         results = self._unique_results(include_unsure=True)
         unlabeled = self._next_pairs("unlabeled")
-        labeled_mask = ~results[["id_existing", "id_new"]].apply(tuple, axis=1).isin(unlabeled)
+        labeled_mask = ~pd.MultiIndex.from_arrays([results["id_existing"], results["id_new"]]).isin(unlabeled)
 
         label_counts = (
             results[labeled_mask]
-            .groupby(["id_existing", "id_new"])["match"]
-            .value_counts()
+            .groupby(["id_existing", "id_new", "match"], observed=True)
+            .size()
             .unstack(fill_value=0)
             .reindex(columns=["yes", "no", "unsure"], fill_value=0)
         )
@@ -257,26 +345,49 @@ class State:
         label_counts["match"] = label_counts[["yes", "no", "unsure"]].idxmax(axis=1)
         label_counts = label_counts.rename(columns={"yes": "count_match", "no": "count_no_match", "unsure": "count_unsure"})
 
-        label_counts.reset_index().to_csv(path, index=False)
+        return label_counts.reset_index()
 
     def _load_results(self) -> List[Dict[str, any]]:
-        if self.results_path.exists():
-            return pd.read_csv(self.results_path).to_dict("records")
+        paths = [path for path in (self.results_path, self.journal_path) if path.exists()]
+        if paths:
+            # Drop earlier labels of relabeled pairs, which may remain in the results file until the journal is compacted
+            results = pd.concat([pd.read_csv(path) for path in paths], ignore_index=True)
+            results = results.drop_duplicates(subset=["id_existing", "id_new", "username"], keep="last")
+            # Represent missing values as None like newly added results, so they are written back as empty fields
+            return results.astype(object).where(results.notna(), None).to_dict("records")
 
         self.results_path.parent.mkdir(parents=True, exist_ok=True)
         return []
 
+    def _append_results(self, results: List[Dict[str, any]]) -> None:
+        # Appending is constant cost per label, whereas rewriting the deduplicated CSV grows with the labeling history.
+        # Appending to a separate journal keeps the results file free of outdated labels of relabeled pairs.
+        write_header = not self.journal_path.exists()
+        pd.DataFrame(results, columns=RESULT_COLUMNS).to_csv(self.journal_path, mode="a", header=write_header, index=False)
+
+        self._appended_since_store += len(results)
+        if self._appended_since_store >= STORE_INTERVAL:
+            self.store_results()
+
     def _unique_results(self, include_unsure: bool = False) -> DataFrame:
         if len(self.results) == 0:
-            return pd.DataFrame(columns=["neighborhood", "id_existing", "id_new", "match", "username", "time"])
+            return pd.DataFrame(columns=RESULT_COLUMNS)
 
-        results = pd.DataFrame(self.results).drop_duplicates(subset=["id_existing", "id_new", "username"], keep="last")
+        # Several helpers are called per request, so build the DataFrame only once after results changed
+        if self._unique_results_cache is None:
+            results = pd.DataFrame(list(self._latest_results.values()), columns=RESULT_COLUMNS)
+            # Categorical label columns use less memory and speed up the repeated groupbys
+            results["match"] = results["match"].astype(pd.CategoricalDtype(["yes", "no", "unsure"]))
+            results[["username", "neighborhood"]] = results[["username", "neighborhood"]].astype("category")
+            self._unique_results_cache = results
+
+        results = self._unique_results_cache
         if not include_unsure:
             results = results[results["match"] != "unsure"]
 
         return results
 
-    def _next_pairs(self, label_mode: str, user: str = None) -> List[Optional[tuple[str, str]]]:
+    def _next_pairs(self, label_mode: str, user: str = None, limit: Optional[int] = None) -> List[Optional[tuple[str, str]]]:
         if label_mode == "all":
             remaining = self._all_pairs()
         elif label_mode == "unlabeled":
@@ -286,9 +397,14 @@ class State:
         else:
             raise ValueError(f"Labeling mode '{label_mode}' is not supported.")
 
-        remaining = remaining.drop(self._labeled_pairs(user), errors="ignore").to_list()
+        if limit is None:
+            return remaining.drop(self._labeled_pairs(user), errors="ignore").to_list()
 
-        return remaining
+        # Only the first few pairs are shown, so stop scanning once enough pairs not labeled by the user are found
+        labeled = self._user_pair_sets.get(user, set())
+        pairs = zip(remaining.get_level_values(0), remaining.get_level_values(1))
+
+        return list(islice((pair for pair in pairs if pair not in labeled), limit))
 
     def _next_neighborhoods(self, label_mode: str, user: str = None) -> List[Optional[str]]:
         if label_mode == "all":
@@ -304,19 +420,47 @@ class State:
 
         return remaining
 
+    def _track_results(self, results: List[Dict[str, any]]) -> None:
+        self._unique_results_cache = None
+        self._unlabeled_pairs_cache = None
+        self._unlabeled_nbh_cache = None
+
+        for result in results:
+            # Keep only the latest label per pair and user, positioned like drop_duplicates(keep="last")
+            key = (result["id_existing"], result["id_new"], result["username"])
+            self._latest_results.pop(key, None)
+            self._latest_results[key] = result
+            self._match_counts[result["match"]] += 1
+
+            pair = (result["id_existing"], result["id_new"])
+            self._pair_set.add(pair)
+            self._user_pair_sets.setdefault(result["username"], set()).add(pair)
+            self._user_nbh_sets.setdefault(result["username"], set()).add(result["neighborhood"])
+
+            if result["match"] != "unsure":
+                self._labeled_pair_set.add(pair)
+                self._labeled_nbh_set.add(result["neighborhood"])
+
+    def _neighborhood_rows(self, rows: Dict[str, np.ndarray], neighborhood: str) -> np.ndarray:
+        return rows.get(neighborhood, np.array([], dtype=np.intp))
+
+    def _neighborhood_pairs(self, neighborhood: str) -> DataFrame:
+        return self._pairs_by_neighborhood.get(neighborhood, self.pairs.iloc[:0])
+
     def _unlabeled_pairs(self) -> Index:
-        labeled_pairs = set((result["id_existing"], result["id_new"]) for result in self.results if result["match"] != "unsure")
-        all_pairs = self._all_pairs()
-        unlabeled = all_pairs.drop(labeled_pairs, errors="ignore")
+        # The next and the subsequent pair are determined per request, so reuse the result until new labels are added
+        if self._unlabeled_pairs_cache is None:
+            all_pairs = self._all_pairs()
+            self._unlabeled_pairs_cache = all_pairs.drop(list(self._labeled_pair_set), errors="ignore")
 
-        return unlabeled
+        return self._unlabeled_pairs_cache
 
     def _unlabeled_neighborhoods(self) -> Index:
-        labeled_nbh = set(result["neighborhood"] for result in self.results if result["match"] != "unsure")
-        all_nbh = set(self.get_all_neighborhoods())
-        unlabeled = Index(all_nbh - labeled_nbh)
+        if self._unlabeled_nbh_cache is None:
+            all_nbh = set(self.get_all_neighborhoods())
+            self._unlabeled_nbh_cache = Index(all_nbh - self._labeled_nbh_set)
 
-        return unlabeled
+        return self._unlabeled_nbh_cache
 
     def _insufficiently_labeled_pairs(self) -> Index:
         labeling_count = self._unique_results().groupby(["id_existing", "id_new"])["username"].nunique()
@@ -325,7 +469,7 @@ class State:
         return insufficiently_labeled
 
     def _insufficiently_labeled_neighborhoods(self) -> Index:
-        labeling_count = self._unique_results().groupby("neighborhood")["username"].nunique()
+        labeling_count = self._unique_results().groupby("neighborhood", observed=True)["username"].nunique()
         insufficiently_labeled = labeling_count[labeling_count < self.annotation_redundancy + 1].index
 
         return insufficiently_labeled
@@ -333,8 +477,8 @@ class State:
     def _ambiguously_labeled_pairs(self) -> Index:
         label_counts = (
             self._unique_results()
-            .groupby(["id_existing", "id_new"])["match"]
-            .value_counts()
+            .groupby(["id_existing", "id_new", "match"], observed=True)
+            .size()
             .unstack(fill_value=0)
             .reindex(columns=["yes", "no"], fill_value=0)
         )
@@ -346,21 +490,17 @@ class State:
         return ambiguous_pairs
 
     def _all_pairs(self) -> Index:
-        return self._shuffled(pd.MultiIndex.from_frame(self.pairs[["id_existing", "id_new"]]))
+        # Candidate pairs never change and the shuffle is seeded, so build the index only once
+        if self._all_pairs_cache is None:
+            self._all_pairs_cache = self._shuffled(pd.MultiIndex.from_frame(self.pairs[["id_existing", "id_new"]]))
 
-    def _labeled_pairs(self, user: str) -> Index:
-        results = self._unique_results(include_unsure=True)
-        user_results = results[results["username"] == user]
-        user_pairs = pd.MultiIndex.from_frame(user_results[["id_existing", "id_new"]])
+        return self._all_pairs_cache
 
-        return user_pairs
-
-    def _labeled_neighborhoods(self, user: str) -> Index:
-        results = self._unique_results(include_unsure=True)
-        user_results = results[results["username"] == user]
-        user_neighborhoods = pd.Index(user_results["neighborhood"].unique())
+    def _labeled_pairs(self, user: str) -> List[tuple[str, str]]:
+        return list(self._user_pair_sets.get(user, ()))
 
-        return user_neighborhoods
+    def _labeled_neighborhoods(self, user: str) -> List[str]:
+        return list(self._user_nbh_sets.get(user, ()))
 
     def _inter_annotator_agreement(self) -> Dict[str, float]:
         """
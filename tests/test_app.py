@@ -0,0 +1,44 @@
+import shutil
+from pathlib import Path
+
+import pytest
+
+from geo_matcher.app import create_app
+
+DATA_PATH = Path(__file__).parent.parent / "geo_matcher" / "data" / "tutorial-neighborhood.pickle"
+
+
+@pytest.fixture
+def client(tmp_path):
+    data_path = tmp_path / "dataset.pickle"
+    shutil.copy(DATA_PATH, data_path)
+
+    app = create_app(str(data_path), annotation_redundancy=0, consensus_margin=1)
+    client = app.test_client()
+    client.post("/start-session", data={"username": "alice", "labelmode": "unlabeled", "dataset": "dataset"})
+
+    with app.app_context():
+        yield client, app.state_handler.get("dataset")
+
+
+def test_show_pair_added_in_neighborhood(client):
+    client, S = client
+    nbh = S.get_next_neighborhood("unlabeled", "alice")
+    pairs = S.get_candidate_pairs(nbh)
+
+    # Match an existing building with a new building that is not its candidate pair
+    id_existing = pairs["id_existing"].iloc[0]
+    candidate_pairs = set(zip(S.pairs["id_existing"], S.pairs["id_new"]))
+    id_new = next(i for i in pairs["id_new"] if (id_existing, i) not in candidate_pairs)
+    added = {"id_existing": id_existing, "id_new": id_new}
+
+    r = client.post("/store-neighborhood", json={
+        "id": nbh,
+        "pairs": pairs[["id_existing", "id_new", "match"]].to_dict("records"),
+        "added": [added],
+        "removed": [],
+    })
+    assert r.status_code == 200
+
+    r = client.get(f"/show-pair/{id_existing}/{id_new}")
+    assert r.status_code == 200